@@ -1,18 +1,46 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta, date, timezone
 from dateutil import tz
-from astral import LocationInfo
+from astral import Observer
 from astral.sun import dawn, dusk, sunrise, sunset
 from skyfield.api import load, wgs84
 from skyfield import almanac
-import requests, os, json, time, threading
+from skyfield.searchlib import find_maxima, find_minima
+import os, json, time, threading, asyncio, socket, sqlite3
+import httpx
+import orjson
+from cachetools import TTLCache
 from typing import Optional
+from functools import lru_cache
+from operator import itemgetter
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 
 # ----- Config -----
 WORLDTIDES_KEY = os.getenv("WORLDTIDES_API_KEY", "")
 TS = load.timescale()
 EPH = load("de421.bsp")  # cached on first run
+EARTH, MOON = EPH["earth"], EPH["moon"]
+
+# Shared async HTTP/2 client for NOAA + WorldTides; one multiplexed connection per host.
+# Created per app lifespan (see on_startup) so a restarted app gets a fresh client.
+CLIENT: Optional[httpx.AsyncClient] = None
+
+def make_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(5.0, read=10.0),
+        # retries= covers connection errors; limits/http2 live on the transport
+        transport=httpx.AsyncHTTPTransport(
+            http2=True, retries=2,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        ),
+    )
+
+# Short-lived memo of computed results; repeat queries skip Skyfield + WorldTides
+DAYPACK_CACHE = TTLCache(maxsize=1024, ttl=3600)
+TIDES_CACHE = TTLCache(maxsize=1024, ttl=6 * 3600)  # extremes don't change intra-day
+CACHE_LOCK = threading.Lock()
 
 app = FastAPI(title="DayPack API")
 
@@ -23,15 +51,27 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"],
 )
 
-def to_local(dt_utc: datetime, tzname: str) -> str:
-    return dt_utc.astimezone(tz.gettz(tzname)).isoformat(timespec="minutes")
+@lru_cache(maxsize=64)
+def get_tz(tzname: str):
+    return tz.gettz(tzname)
+
+# Coordinates are rounded to ~10 m so nearby requests share one object
+@lru_cache(maxsize=512)
+def _topos(lat_r, lon_r):
+    return wgs84.latlon(lat_r, lon_r)
 
-def sun_block(lat, lon, tzname, d: date):
-    loc = LocationInfo(latitude=lat, longitude=lon, timezone=tzname)
-    adawn = dawn(loc.observer, d, depression=18)     # astronomical
-    adusk = dusk(loc.observer, d, depression=18)
-    sr = sunrise(loc.observer, d)
-    ss = sunset(loc.observer, d)
+@lru_cache(maxsize=512)
+def _observer(lat_r, lon_r):
+    return Observer(latitude=lat_r, longitude=lon_r)
+
+def sun_block(lat, lon, tzinfo, d: date):
+    observer = _observer(round(lat, 4), round(lon, 4))
+    # Called individually on purpose: astral.sun.sun() just runs these same
+    # solvers one by one (plus noon), so it would be more work, not less
+    adawn = dawn(observer, d, depression=18)     # astronomical
+    adusk = dusk(observer, d, depression=18)
+    sr = sunrise(observer, d)
+    ss = sunset(observer, d)
 
     # Only keep events that actually happen on the requested local date
     events = []
@@ -41,31 +81,33 @@ def sun_block(lat, lon, tzname, d: date):
         (ss,    "Sunset"),
         (adusk, "Astronomical dusk"),
     ]:
-        local = dt_val.astimezone(tz.gettz(tzname))
+        local = dt_val.astimezone(tzinfo)
         if local.date() == d:
             events.append({"time_local": local.isoformat(timespec="minutes"),
                            "label": label})
+    # Astral solves per UTC date, so after the local filter dusk can land past local midnight
+    events.sort(key=itemgetter("time_local"))
     return events
 
 
-def moon_block(lat, lon, tzname, d: date):
-    # 36h window so events near midnight still show on the target date
-    start_local = datetime(d.year, d.month, d.day, 0, 0, tzinfo=tz.gettz(tzname))
-    end_local   = start_local + timedelta(hours=36)
+def moon_block(lat, lon, tzinfo, d: date):
+    # Local day ±2h so events near midnight still show on the target date;
+    # anything further out is filtered below, so searching it is wasted work
+    start_local = datetime(d.year, d.month, d.day, 0, 0, tzinfo=tzinfo) - timedelta(hours=2)
+    end_local   = datetime.combine(d + timedelta(days=1), datetime.min.time(), tzinfo=tzinfo) + timedelta(hours=2)
     t0 = TS.from_datetime(start_local.astimezone(timezone.utc))
     t1 = TS.from_datetime(end_local.astimezone(timezone.utc))
 
-    # Use lowercase keys and pass a Topos (lat/lon), not earth+topos
-    topos = wgs84.latlon(lat, lon)
-    moon = EPH["moon"]   # lowercase
+    # Pass a Topos (lat/lon), not earth+topos
+    topos = _topos(round(lat, 4), round(lon, 4))
 
     events = []
 
     # Moonrise / Moonset
-    f_rs = almanac.risings_and_settings(EPH, moon, topos)
+    f_rs = almanac.risings_and_settings(EPH, MOON, topos)
     t_rs, y_rs = almanac.find_discrete(t0, t1, f_rs)
     for t, y in zip(t_rs, y_rs):
-        local = t.utc_datetime().astimezone(tz.gettz(tzname))
+        local = t.utc_datetime().astimezone(tzinfo)
         if local.date() == d:
             events.append({
                 "time_local": local.isoformat(timespec="minutes"),
@@ -73,19 +115,20 @@ def moon_block(lat, lon, tzname, d: date):
             })
 
     # Meridian transits (upper/lower)
-    f_tr = almanac.meridian_transits(EPH, moon, topos)
+    f_tr = almanac.meridian_transits(EPH, MOON, topos)
     t_tr, y_tr = almanac.find_discrete(t0, t1, f_tr)
     for t, y in zip(t_tr, y_tr):
-        local = t.utc_datetime().astimezone(tz.gettz(tzname))
+        local = t.utc_datetime().astimezone(tzinfo)
         if local.date() == d:
             events.append({
                 "time_local": local.isoformat(timespec="minutes"),
                 "label": "Moon above" if y == 1 else "Moon below"
             })
 
+    events.sort(key=itemgetter("time_local"))
     return events
 
-def phases_perigee_apogee(tzname, d: date):
+def phases_perigee_apogee(tzinfo, d: date):
     # Phases in a ±1 day window (discrete events)
     t0 = TS.from_datetime(datetime(d.year, d.month, d.day, 0, 0, tzinfo=timezone.utc) - timedelta(days=1))
     t1 = TS.from_datetime(datetime(d.year, d.month, d.day, 0, 0, tzinfo=timezone.utc) + timedelta(days=2))
@@ -95,92 +138,117 @@ def phases_perigee_apogee(tzname, d: date):
 
     out = []
     for t, p in zip(times, phases):
-        when_local = t.utc_datetime().astimezone(tz.gettz(tzname))
+        when_local = t.utc_datetime().astimezone(tzinfo)
         if when_local.date() == d:
             out.append({"time_local": when_local.isoformat(timespec="minutes"),
                         "label": labels.get(int(p), "Moon phase")})
 
-    # Perigee / Apogee: scan a 36h window for local minima/maxima of Earth–Moon distance
-    earth, moon = EPH["Earth"], EPH["Moon"]
+    # Perigee / Apogee: solve for minima/maxima of Earth–Moon distance in a 36h window
     start = datetime(d.year, d.month, d.day, 0, 0, tzinfo=timezone.utc) - timedelta(hours=12)
-    points = []
-    for k in range(0, 72 + 1):  # 36h, 30-minute steps
-        tt = TS.from_datetime(start + timedelta(minutes=30 * k))
-        km = (earth - moon).at(tt).distance().km
-        points.append((tt, km))
-    for i in range(1, len(points) - 1):
-        t_prev, d_prev = points[i - 1]
-        t_curr, d_curr = points[i]
-        t_next, d_next = points[i + 1]
-        is_min = d_curr < d_prev and d_curr < d_next
-        is_max = d_curr > d_prev and d_curr > d_next
-        if not (is_min or is_max):
-            continue
-        when_local = t_curr.utc_datetime().astimezone(tz.gettz(tzname))
-        if when_local.date() == d:
-            label = "Perigee" if is_min else "Apogee"
-            out.append({"time_local": when_local.isoformat(timespec="minutes"),
-                        "label": f"{label} ({round(d_curr):,} km)"})
+    t0 = TS.from_datetime(start)
+    t1 = TS.from_datetime(start + timedelta(hours=36))
+
+    def moon_distance(t):
+        return (EARTH - MOON).at(t).distance().km
+    moon_distance.step_days = 0.5
+
+    for label, (times, kms) in [("Perigee", find_minima(t0, t1, moon_distance)),
+                                ("Apogee",  find_maxima(t0, t1, moon_distance))]:
+        for t, km in zip(times, kms):
+            when_local = t.utc_datetime().astimezone(tzinfo)
+            if when_local.date() == d:
+                out.append({"time_local": when_local.isoformat(timespec="minutes"),
+                            "label": f"{label} ({round(km):,} km)"})
+    out.sort(key=itemgetter("time_local"))
     return out
 
-def tides(lat, lon, tzname, d: date):
+# Returns None when WorldTides fails, so callers can tell it apart from "no tides"
+async def tides(lat, lon, tzinfo, d: date):
     # If no key, just skip tides
     if not WORLDTIDES_KEY:
         return []
 
-    # Build the request
-    start_ts = int(datetime(d.year, d.month, d.day, 0, 0, tzinfo=timezone.utc).timestamp())
+    # Build the request for the local calendar day (length is in seconds;
+    # 23h/25h on DST changes)
+    start_ts = int(datetime(d.year, d.month, d.day, 0, 0, tzinfo=tzinfo).timestamp())
+    end_ts = int(datetime.combine(d + timedelta(days=1), datetime.min.time(), tzinfo=tzinfo).timestamp())
+    length = end_ts - start_ts
     url = (
         "https://www.worldtides.info/api/v3"
-        f"?extremes&lat={lat}&lon={lon}&start={start_ts}&length=1&key={WORLDTIDES_KEY}"
+        f"?extremes&lat={lat}&lon={lon}&start={start_ts}&length={length}&key={WORLDTIDES_KEY}"
     )
 
+    key = (round(lat, 1), round(lon, 1), start_ts, length)
+    with CACHE_LOCK:
+        extremes = TIDES_CACHE.get(key)
+
     try:
-        # Shorter timeouts + tiny retry so it doesn’t hang your whole request
-        data = None
-        for _ in range(2):  # up to 2 attempts
-            r = requests.get(url, timeout=(5, 10))  # (connect, read) seconds
-            if r.status_code == 200:
-                data = r.json()
+        if extremes is None:
+            # Shorter timeouts + tiny retry so it doesn’t hang your whole request
+            data = None
+            for _ in range(2):  # up to 2 attempts
+                r = await CLIENT.get(url)  # timeouts come from CLIENT
+                if r.status_code == 200:
+                    data = r.json()
+                    break
+                # non-200 → stop trying; report as a failed fetch
                 break
-            # non-200 → stop trying; treat as no-tide-data
-            break
 
-        if not data:
-            return []
+            if not data:
+                return None
+
+            extremes = data.get("extremes", [])
+            with CACHE_LOCK:
+                TIDES_CACHE[key] = extremes
 
         out = []
-        for e in data.get("extremes", []):
+        for e in extremes:
             when_utc = datetime.fromtimestamp(e["dt"], tz=timezone.utc)
-            when_local = when_utc.astimezone(tz.gettz(tzname))
+            when_local = when_utc.astimezone(tzinfo)
             if when_local.date() == d:
                 label = f"{e['type'].title()} tide"
                 if e.get("height") is not None:
                     label += f" {e['height']:.2f} m"
                 out.append({"time_local": when_local.isoformat(timespec="minutes"), "label": label})
+        out.sort(key=itemgetter("time_local"))
         return out
 
     except Exception as exc:
         # Log and carry on with no tides instead of crashing the endpoint
         print(f"[tides] error: {exc}")
-        return []
+        return None
 
 
 @app.get("/daypack")
-def daypack(
+async def daypack(
     lat: float = Query(..., description="Latitude"),
     lon: float = Query(..., description="Longitude"),
     date_str: str = Query(..., description="YYYY-MM-DD"),
     tzname: str = Query("Australia/Brisbane", description="IANA timezone"),
 ):
-    d = datetime.fromisoformat(date_str).date()
-    events = []
-    events += sun_block(lat, lon, tzname, d)
-    events += moon_block(lat, lon, tzname, d)
-    events += phases_perigee_apogee(tzname, d)
-    events += tides(lat, lon, tzname, d)
-    events.sort(key=lambda x: x["time_local"])
-    return {"events": events, "meta": {"lat": lat, "lon": lon, "date": date_str, "tz": tzname}}
+    d = date.fromisoformat(date_str)
+    meta = {"lat": lat, "lon": lon, "date": date_str, "tz": tzname}
+    key = (round(lat, 2), round(lon, 2), d, tzname)
+    with CACHE_LOCK:
+        cached = DAYPACK_CACHE.get(key)
+    if cached is not None:
+        return {"events": cached, "meta": meta}
+
+    tzinfo = get_tz(tzname)
+    # Skyfield/astral work runs in threads while the tides request is in flight
+    sun, moon, phases, tide = await asyncio.gather(
+        asyncio.to_thread(sun_block, lat, lon, tzinfo, d),
+        asyncio.to_thread(moon_block, lat, lon, tzinfo, d),
+        asyncio.to_thread(phases_perigee_apogee, tzinfo, d),
+        tides(lat, lon, tzinfo, d),
+    )
+    # Each block is already time-ordered, so a k-way merge replaces a full sort
+    events = list(heapq.merge(sun, moon, phases, tide or [], key=itemgetter("time_local")))
+    # Don't pin a tide-less answer for an hour because WorldTides hiccuped
+    if tide is not None:
+        with CACHE_LOCK:
+            DAYPACK_CACHE[key] = events
+    return {"events": events, "meta": meta}
 
 # ---------- Kp endpoints ----------
 NOAA_KP_1M = "https://services.swpc.noaa.gov/json/planetary_k_index_1m.json"
@@ -193,37 +261,74 @@ def kp_to_g(kp: float) -> Optional[str]:
     if kp >= 5: return "G1"
     return None
 
-@app.get("/kp")
-def kp_last_3_days():
-    r = requests.get(NOAA_KP_1M, timeout=20)
-    r.raise_for_status()
-    data = r.json()
-    series = []
-    for row in data:
-        t = row.get("time_tag")
-        est = row.get("estimated_kp")
-        if t is None or est is None:
-            continue
-        series.append({"time_utc": t, "kp": float(est)})
-    series.sort(key=lambda x: x["time_utc"])
+# Parsed NOAA feed, refreshed by kp_watch_loop; endpoints read from here
+KP_CACHE = {"fetched_at": 0, "x": [], "y": [], "series": [], "last": None, "g": None}
+KP_LOCK = threading.RLock()
+KP_MAX_AGE = 600  # seconds before endpoints fetch for themselves
+KP_INFLIGHT: Optional[asyncio.Task] = None
+
+def _parse_kp(content: bytes):
+    data = orjson.loads(content)
+    rows = [(row.get("time_tag"), row.get("estimated_kp")) for row in data]
+    rows = [(t, float(est)) for t, est in rows if t is not None and est is not None]
+    # NOAA already serves the feed in time order; only sort if that ever changes
+    if any(rows[i][0] > rows[i + 1][0] for i in range(len(rows) - 1)):
+        rows.sort(key=lambda r: r[0])
+    xs = [t for t, _ in rows]
+    ys = [kp for _, kp in rows]
+    return xs, ys
+
+def store_kp(content: bytes) -> dict:
+    xs, ys = _parse_kp(content)
+    series = [{"time_utc": t, "kp": kp} for t, kp in zip(xs, ys)]
     last = series[-1] if series else None
     g = kp_to_g(last["kp"]) if last else None
-    return {"series": series, "last_point": last, "g_level": g}
+    with KP_LOCK:
+        KP_CACHE.update(fetched_at=time.time(), x=xs, y=ys, series=series, last=last, g=g)
+        return dict(KP_CACHE)
+
+async def _fetch_kp() -> dict:
+    # Retry NOAA's transient gateway errors with a short backoff
+    for attempt in range(3):
+        r = await CLIENT.get(NOAA_KP_1M, timeout=20)
+        if r.status_code not in (502, 503, 504) or attempt == 2:
+            break
+        await asyncio.sleep(0.3 * 2 ** attempt)
+    r.raise_for_status()
+    # Parsing ~3 MB of JSON shouldn't stall the event loop
+    return await asyncio.to_thread(store_kp, r.content)
+
+def _clear_kp_inflight(task):
+    global KP_INFLIGHT
+    if KP_INFLIGHT is task:
+        KP_INFLIGHT = None
+
+async def refresh_kp() -> dict:
+    # Single-flight: concurrent callers (watcher, /kp, /kp_line) share one fetch
+    global KP_INFLIGHT
+    if KP_INFLIGHT is None:
+        KP_INFLIGHT = asyncio.create_task(_fetch_kp())
+        KP_INFLIGHT.add_done_callback(_clear_kp_inflight)
+    # shield: a cancelled caller must not cancel the fetch others are waiting on
+    return await asyncio.shield(KP_INFLIGHT)
+
+async def get_kp() -> dict:
+    with KP_LOCK:
+        if time.time() - KP_CACHE["fetched_at"] <= KP_MAX_AGE:
+            return dict(KP_CACHE)
+    # Cold start or watcher stalled: fetch inline
+    return await refresh_kp()
+
+@app.get("/kp")
+async def kp_last_3_days():
+    kp = await get_kp()
+    return {"series": kp["series"], "last_point": kp["last"], "g_level": kp["g"]}
 
 @app.get("/kp_line")
-def kp_line():
-    r = requests.get(NOAA_KP_1M, timeout=20)
-    r.raise_for_status()
-    data = r.json()
-    xs, ys = [], []
-    for row in data:
-        t = row.get("time_tag")
-        est = row.get("estimated_kp")
-        if t is None or est is None:
-            continue
-        xs.append(t)
-        ys.append(float(est))
-    return {"x": xs, "y": ys}
+async def kp_line():
+    kp = await get_kp()
+    # Encoded with orjson and returned as-is so the ~4k-point arrays skip jsonable_encoder
+    return Response(orjson.dumps({"x": kp["x"], "y": kp["y"]}), media_type="application/json")
 
 # ---------- Optional: Push via Firebase Admin ----------
 FIREBASE_CRED_JSON = os.getenv("FIREBASE_CREDENTIALS_JSON")
@@ -237,59 +342,234 @@ if FIREBASE_ENABLED:
     except ValueError:
         pass
 
-DEVICE_TOKENS = set()
+# ---------- Device token store ----------
+# Shared across workers and restarts: Redis when REDIS_URL is set, else a SQLite file.
+# Opened in on_startup, not at import.
+REDIS_URL = os.getenv("REDIS_URL")
+TOKENS_DB = os.getenv("DEVICE_TOKENS_DB")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+REDIS = None
+RENEW_LEASE = None
+TOKENS_SQL = None
+
+def open_token_store():
+    global REDIS, RENEW_LEASE, TOKENS_SQL
+    if REDIS_URL:
+        import redis
+        REDIS = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        # Renew only if we still own the lease; GET + EXPIRE as two calls could
+        # extend a lease another worker took over in between
+        RENEW_LEASE = REDIS.register_script(
+            "if redis.call('GET', KEYS[1]) == ARGV[1] then "
+            "return redis.call('EXPIRE', KEYS[1], ARGV[2]) else return 0 end"
+        )
+        return
+    path = TOKENS_DB
+    if not path:
+        path = "device_tokens.sqlite3"
+        print(f"[tokens] warning: REDIS_URL and DEVICE_TOKENS_DB unset; using ./{path}, "
+              "which won't survive a redeploy on an ephemeral filesystem")
+    TOKENS_SQL = sqlite3.connect(path, check_same_thread=False)
+    TOKENS_SQL.execute("PRAGMA journal_mode=WAL")
+    TOKENS_SQL.execute("CREATE TABLE IF NOT EXISTS device_tokens (token TEXT PRIMARY KEY)")
+    TOKENS_SQL.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+    TOKENS_SQL.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)")
+    TOKENS_SQL.commit()
+
+def close_token_store():
+    global REDIS, RENEW_LEASE, TOKENS_SQL
+    if REDIS is not None:
+        REDIS.close()
+    if TOKENS_SQL is not None:
+        TOKENS_SQL.close()
+    REDIS = RENEW_LEASE = TOKENS_SQL = None
+
+TOKENS_LOCK = threading.Lock()  # one SQLite connection shared by handler and push threads
+
+def tokens_add(token: str) -> int:
+    if REDIS is not None:
+        REDIS.sadd("device_tokens", token)
+        return REDIS.scard("device_tokens")
+    with TOKENS_LOCK:
+        TOKENS_SQL.execute("INSERT OR IGNORE INTO device_tokens (token) VALUES (?)", (token,))
+        TOKENS_SQL.commit()
+        return TOKENS_SQL.execute("SELECT COUNT(*) FROM device_tokens").fetchone()[0]
+
+def tokens_remove(*tokens: str) -> int:
+    if REDIS is not None:
+        if tokens:
+            REDIS.srem("device_tokens", *tokens)
+        return REDIS.scard("device_tokens")
+    with TOKENS_LOCK:
+        TOKENS_SQL.executemany("DELETE FROM device_tokens WHERE token = ?", [(t,) for t in tokens])
+        TOKENS_SQL.commit()
+        return TOKENS_SQL.execute("SELECT COUNT(*) FROM device_tokens").fetchone()[0]
+
+def tokens_all() -> list:
+    if REDIS is not None:
+        return list(REDIS.smembers("device_tokens"))
+    with TOKENS_LOCK:
+        return [row[0] for row in TOKENS_SQL.execute("SELECT token FROM device_tokens")]
+
+# Take or renew a named lease; True while this worker holds it
+def acquire_lease(name: str, ttl: int) -> bool:
+    if REDIS is not None:
+        if REDIS.set(name, WORKER_ID, nx=True, ex=ttl):
+            return True
+        return bool(RENEW_LEASE(keys=[name], args=[WORKER_ID, ttl]))
+    now = time.time()
+    with TOKENS_LOCK:
+        TOKENS_SQL.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+            (name, WORKER_ID, now + ttl, now),
+        )
+        TOKENS_SQL.commit()
+        row = TOKENS_SQL.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+    return row is not None and row[0] == WORKER_ID
+
+# Small shared key/value slots (e.g. the last storm level pushed), same backend as tokens
+def state_get(name: str) -> Optional[str]:
+    if REDIS is not None:
+        return REDIS.get(name)
+    with TOKENS_LOCK:
+        row = TOKENS_SQL.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def state_set(name: str, value: Optional[str]):
+    if REDIS is not None:
+        if value is None:
+            REDIS.delete(name)
+        else:
+            REDIS.set(name, value)
+        return
+    with TOKENS_LOCK:
+        if value is None:
+            TOKENS_SQL.execute("DELETE FROM state WHERE name = ?", (name,))
+        else:
+            TOKENS_SQL.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, value))
+        TOKENS_SQL.commit()
 
 @app.post("/register_device")
-def register_device(token: str):
-    DEVICE_TOKENS.add(token)
-    return {"ok": True, "count": len(DEVICE_TOKENS)}
+async def register_device(token: str):
+    count = await asyncio.to_thread(tokens_add, token)
+    return {"ok": True, "count": count}
 
 @app.post("/unregister_device")
-def unregister_device(token: str):
-    DEVICE_TOKENS.discard(token)
-    return {"ok": True, "count": len(DEVICE_TOKENS)}
-
-def send_push_all(title: str, body: str):
-    if not FIREBASE_ENABLED or not DEVICE_TOKENS:
-        return
+async def unregister_device(token: str):
+    count = await asyncio.to_thread(tokens_remove, token)
+    return {"ok": True, "count": count}
+
+# True if at least one device accepted the push
+def send_push_all(title: str, body: str) -> bool:
+    if not FIREBASE_ENABLED:
+        return False
     try:
-        from firebase_admin import messaging
+        from firebase_admin import messaging, exceptions
     except Exception:
-        return
-    for token in list(DEVICE_TOKENS):
-        try:
-            messaging.send(messaging.Message(
-                notification=messaging.Notification(title=title, body=body),
-                token=token
-            ))
-        except Exception:
-            DEVICE_TOKENS.discard(token)
-
-LAST_SENT_LEVEL = None
-
-def kp_watch_loop():
-    global LAST_SENT_LEVEL
+        return False
+    tokens = tokens_all()
+    if not tokens:
+        return False
+
+    notification = messaging.Notification(title=title, body=body)
+    # Only drop tokens FCM says are dead; transient failures keep them
+    dead_errors = (messaging.UnregisteredError, exceptions.InvalidArgumentError)
+    dead = []
+    delivered = False
+
+    if hasattr(messaging, "send_each_for_multicast"):
+        # One batched FCM call per 500 tokens (the multicast limit)
+        for i in range(0, len(tokens), 500):
+            batch = tokens[i:i + 500]
+            try:
+                resp = messaging.send_each_for_multicast(messaging.MulticastMessage(
+                    notification=notification,
+                    tokens=batch
+                ))
+            except Exception:
+                continue
+            delivered = delivered or resp.success_count > 0
+            dead += [t for t, res in zip(batch, resp.responses)
+                     if isinstance(res.exception, dead_errors)]
+    else:
+        # Older SDKs: one request per token, fanned out over a small pool
+        def _send_one(token):
+            try:
+                messaging.send(messaging.Message(notification=notification, token=token))
+            except Exception as exc:
+                return exc
+            return None
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            results = list(ex.map(_send_one, tokens))
+        delivered = any(exc is None for exc in results)
+        dead += [t for t, exc in zip(tokens, results) if isinstance(exc, dead_errors)]
+
+    if dead:
+        tokens_remove(*dead)
+    return delivered
+
+KP_WATCH_TASK = None
+
+KP_POLL_SECONDS = 300
+KP_RETRY_MIN, KP_RETRY_MAX = 30, 600  # backoff bounds while NOAA is failing
+KP_LEADER_TTL = KP_RETRY_MAX + 60  # outlives the leader's longest sleep
+
+# Last level pushed lives in the shared store so a newly elected leader doesn't repeat it
+def notify_kp_level(kp_val: float, g: Optional[str]):
+    last_sent = state_get("kp_last_sent_level")
+    order = {"G1":1,"G2":2,"G3":3,"G4":4,"G5":5}
+    if g and (last_sent is None or order[g] > order.get(last_sent, 0)):
+        # Only record the level once someone actually got it; otherwise retry next cycle
+        if send_push_all(f"Geomagnetic storm {g}", f"Current Kp ≈ {kp_val:.1f}"):
+            state_set("kp_last_sent_level", g)
+    if not g and last_sent is not None:
+        state_set("kp_last_sent_level", None)
+
+async def kp_watch_loop():
+    failures = 0
     while True:
         try:
-            resp = requests.get(NOAA_KP_1M, timeout=20).json()
-            if resp:
-                row = resp[-1]
-                kp_val = float(row.get("estimated_kp", 0))
-                g = kp_to_g(kp_val)
-                order = {"G1":1,"G2":2,"G3":3,"G4":4,"G5":5}
-                if g and (LAST_SENT_LEVEL is None or order[g] > order.get(LAST_SENT_LEVEL, 0)):
-                    send_push_all(f"Geomagnetic storm {g}", f"Current Kp ≈ {kp_val:.1f}")
-                    LAST_SENT_LEVEL = g
-                if not g:
-                    LAST_SENT_LEVEL = None
+            # Every worker keeps its own KP_CACHE warm; only the lease holder sends pushes
+            kp = await refresh_kp()
+            if kp["last"] and await asyncio.to_thread(acquire_lease, "kp_watcher_leader", KP_LEADER_TTL):
+                await asyncio.to_thread(notify_kp_level, kp["last"]["kp"], kp["g"])
+            failures = 0
         except Exception:
-            pass
-        time.sleep(300)
-
-def start_kp_thread():
-    t = threading.Thread(target=kp_watch_loop, daemon=True)
-    t.start()
+            failures += 1
+        # Retry sooner after a failure, then back off exponentially
+        delay = KP_POLL_SECONDS if not failures else min(KP_RETRY_MIN * 2 ** (failures - 1), KP_RETRY_MAX)
+        await asyncio.sleep(delay)
+
+def warm_ephemeris():
+    # Ask the kernel to read the .bsp into page cache ahead of first use
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(load.path_to("de421.bsp"), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    # Touch the Earth/Moon segments so the first /daypack doesn't fault them in
+    (EARTH - MOON).at(TS.now()).distance().km
 
 @app.on_event("startup")
-def on_startup():
-    start_kp_thread()
+async def on_startup():
+    global KP_WATCH_TASK, CLIENT
+    CLIENT = make_client()
+    await asyncio.to_thread(open_token_store)
+    try:
+        await asyncio.to_thread(warm_ephemeris)
+    except Exception as exc:
+        # A cold first request is better than failing startup
+        print(f"[warmup] error: {exc}")
+    KP_WATCH_TASK = asyncio.create_task(kp_watch_loop())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if KP_WATCH_TASK is not None:
+        KP_WATCH_TASK.cancel()
+    if CLIENT is not None:
+        await CLIENT.aclose()
+    await asyncio.to_thread(close_token_store)